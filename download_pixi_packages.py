@@ -1,17 +1,106 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import re
 import sys
-import urllib.parse
+import threading
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+from urllib3.util.retry import Retry
+
+# Use the libyaml-based loader when PyYAML is built with it, which parses large
+# lockfiles many times faster than the pure-Python loader.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# orjson parses and writes the cache files faster than json, if it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A progress bar is shown if tqdm is installed
+try:
+    from tqdm import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
+except ImportError:
+    tqdm = None
+
+logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 # Version of the pixi.lock format this script is primarily designed for
 SUPPORTED_LOCKFILE_VERSION = 6
+# URL prefixes of packages that can be downloaded
+HTTP_PREFIXES = ("http://", "https://")
+# Platform subdirectory and filename at the end of a package URL path, e.g.
+# https://conda.anaconda.org/conda-forge/linux-64/some-package.conda. A query
+# string or fragment after the path is allowed.
+PACKAGE_URL_PATTERN = re.compile(
+    r"^https?://[^/?#]+/(?:[^/?#]+/)*([^/?#]+)/([^/?#]+)(?:[?#].*)?$"
+)
+# User-Agent sent with all requests
+USER_AGENT = f"tsd-conda-channel-creator/0.1.0 {requests.utils.default_user_agent()}"
 # Timeout for network requests in seconds
 REQUEST_TIMEOUT = 60
 # Chunk size for downloading files
-DOWNLOAD_CHUNK_SIZE = 8192
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of attempts for a download that is interrupted or fails verification
+DOWNLOAD_ATTEMPTS = 3
+# Base delay in seconds between attempts, doubled for every retry
+DOWNLOAD_RETRY_BACKOFF = 1.0
+# Suffix of incomplete downloads, which are resumed on the next attempt
+PARTIAL_SUFFIX = ".part"
+# Directory for caching the package URLs extracted from lockfiles
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tsd-conda"
+)
+# Default number of packages downloaded concurrently
+DEFAULT_JOBS = 8
+# Default number of concurrent downloads from a single host. Package servers
+# may rate limit clients that open many connections at once.
+DEFAULT_MAX_PER_HOST = 8
+# Connection pool sizes for the shared HTTP session. The pool size per host is
+# raised to the number of download workers if that is larger.
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 64
+# Retries on connection errors and transient server responses
+MAX_RETRIES = Retry(
+    total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)
+)
+
+
+def mount_adapter(session, pool_maxsize):
+    """Mounts a pooling and retrying HTTP adapter on the session."""
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        max_retries=MAX_RETRIES,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+# A single session shared by all downloads, such that keep-alive connections
+# to the package hosts are reused instead of doing a TCP+TLS handshake per file.
+SESSION = requests.Session()
+mount_adapter(SESSION, POOL_MAXSIZE)
+# Packages are already compressed archives. Asking for them unencoded avoids
+# servers spending time re-compressing them, and keeps byte ranges used for
+# resuming downloads aligned with the bytes written to disk.
+SESSION.headers["Accept-Encoding"] = "identity"
+SESSION.headers["User-Agent"] = USER_AGENT
+# Set on Ctrl-C to stop the running downloads, which keep their partial files
+STOP_DOWNLOADS = threading.Event()
 
 
 def parse_arguments():
@@ -32,281 +121,664 @@ def parse_arguments():
         action="store_true",
         help="Force download even if the file already exists in the output directory.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="Check with the server whether existing files have changed since they "
+        "were downloaded (using ETag/Last-Modified), and download them again if so.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log every package that is downloaded or skipped.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Number of packages to download concurrently (default: {DEFAULT_JOBS}).",
+    )
+    parser.add_argument(
+        "--max-per-host",
+        type=int,
+        default=DEFAULT_MAX_PER_HOST,
+        help="Maximum number of concurrent downloads from a single host "
+        f"(default: {DEFAULT_MAX_PER_HOST}).",
+    )
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if args.max_per_host < 1:
+        parser.error("--max-per-host must be at least 1.")
+    return args
 
 
 def load_lockfile(lockfile_path):
     """Loads and parses the YAML lockfile."""
     if not os.path.exists(lockfile_path):
-        print(f"Error: Lockfile not found at '{lockfile_path}'", file=sys.stderr)
+        logger.error(f"Lockfile not found at '{lockfile_path}'")
         sys.exit(1)
     if not os.path.isfile(lockfile_path):
-        print(f"Error: Lockfile path '{lockfile_path}' is not a file.", file=sys.stderr)
+        logger.error(f"Lockfile path '{lockfile_path}' is not a file.")
         sys.exit(1)
     try:
         with open(lockfile_path, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f)
+            data = yaml.load(f, Loader=SafeLoader)
         if not isinstance(data, dict):
-            print(
-                f"Error: Lockfile '{lockfile_path}' is not a valid YAML dictionary.",
-                file=sys.stderr,
-            )
+            logger.error(f"Lockfile '{lockfile_path}' is not a valid YAML dictionary.")
             sys.exit(1)
 
         file_version = data.get("version")
         if file_version != SUPPORTED_LOCKFILE_VERSION:
-            print(
-                f"Warning: This script is designed for pixi.lock version {SUPPORTED_LOCKFILE_VERSION}. "
+            logger.warning(
+                f"This script is designed for pixi.lock version {SUPPORTED_LOCKFILE_VERSION}. "
                 f"The provided file is version '{file_version}'. "
-                "Proceeding, but there might be issues if the structure changed significantly.",
-                file=sys.stderr,
+                "Proceeding, but there might be issues if the structure changed significantly."
             )
         return data
     except yaml.YAMLError as e:
-        print(f"Error parsing YAML file '{lockfile_path}': {e}", file=sys.stderr)
+        logger.error(f"Error parsing YAML file '{lockfile_path}': {e}")
         sys.exit(1)
     except Exception as e:
-        print(
-            f"An unexpected error occurred while reading '{lockfile_path}': {e}",
-            file=sys.stderr,
+        logger.error(
+            f"An unexpected error occurred while reading '{lockfile_path}': {e}"
         )
         sys.exit(1)
 
 
+def iter_conda_urls(packages, warn_malformed=False):
+    """
+    Yields the HTTP(S) URLs of the 'conda' entries in a list of lockfile
+    packages, together with their sha256 checksum if the lockfile has one.
+    """
+    for package_info in packages:
+        url = package_info.get("conda") if isinstance(package_info, dict) else None
+        if url is None:
+            continue
+        if isinstance(url, str) and url.startswith(HTTP_PREFIXES):
+            sha256 = package_info.get("sha256")
+            yield url, sha256 if isinstance(sha256, str) else None
+        elif warn_malformed:
+            logger.warning(
+                f"Skipping malformed or non-HTTP URL in top-level 'packages' list: {url}"
+            )
+
+
 def extract_conda_package_urls(lockfile_data):
-    """Extracts all unique Conda package URLs from the lockfile data."""
-    urls = set()
+    """
+    Extracts all unique Conda package URLs from the lockfile data, as a list of
+    (url, sha256) pairs. sha256 is None if the lockfile has no checksum.
+    """
     # Primary source of URLs in v6 format
-    if "packages" in lockfile_data and isinstance(lockfile_data["packages"], list):
-        for package_info in lockfile_data["packages"]:
-            if isinstance(package_info, dict) and "conda" in package_info:
-                url = package_info["conda"]
-                if isinstance(url, str) and url.startswith("http"):
-                    urls.add(url)
-                else:
-                    print(
-                        f"Warning: Skipping malformed or non-HTTP URL in top-level 'packages' list: {url}",
-                        file=sys.stderr,
-                    )
-            # else:
-            #     print(f"Debug: Skipping entry in top-level 'packages' not matching expected structure: {package_info}", file=sys.stderr)
+    packages = lockfile_data.get("packages")
+    urls = dict(
+        iter_conda_urls(packages, warn_malformed=True)
+        if isinstance(packages, list)
+        else ()
+    )
 
     # Fallback: Check within environments if the primary method yielded no URLs
     # This is more for robustness or if the structure guarantees diverge.
-    if (
-        not urls
-        and "environments" in lockfile_data
-        and isinstance(lockfile_data["environments"], dict)
-    ):
-        print(
-            "Info: No URLs found in top-level 'packages'. Checking 'environments' section.",
-            file=sys.stderr,
+    environments = lockfile_data.get("environments")
+    if not urls and isinstance(environments, dict):
+        logger.info(
+            "No URLs found in top-level 'packages'. Checking 'environments' section."
         )
-        for env_name, env_data in lockfile_data["environments"].items():
-            if (
-                isinstance(env_data, dict)
-                and "packages" in env_data
-                and isinstance(env_data["packages"], dict)
-            ):
-                for platform, platform_packages_list in env_data["packages"].items():
-                    if isinstance(platform_packages_list, list):
-                        for pkg_url_map in platform_packages_list:
-                            if isinstance(pkg_url_map, dict) and "conda" in pkg_url_map:
-                                url = pkg_url_map["conda"]
-                                if isinstance(url, str) and url.startswith("http"):
-                                    urls.add(url)
-                                # else:
-                                #     print(f"Debug: Skipping malformed 'conda' entry in environment '{env_name}/{platform}': {url}", file=sys.stderr)
+        for env_data in environments.values():
+            env_packages = (
+                env_data.get("packages") if isinstance(env_data, dict) else None
+            )
+            if not isinstance(env_packages, dict):
+                continue
+            for platform_packages_list in env_packages.values():
+                if isinstance(platform_packages_list, list):
+                    urls.update(iter_conda_urls(platform_packages_list))
 
     if not urls:
-        print("No Conda package URLs found in the lockfile.", file=sys.stderr)
-    return list(urls)
+        logger.warning("No Conda package URLs found in the lockfile.")
+    return list(urls.items())
+
+
+def get_validators(response):
+    """Returns the ETag and Last-Modified headers of a response."""
+    return {
+        key: response.headers[header]
+        for key, header in (("etag", "ETag"), ("last_modified", "Last-Modified"))
+        if header in response.headers
+    }
+
+
+class ChecksumMismatchError(Exception):
+    """Raised when a downloaded file does not match its lockfile checksum."""
+
+
+class DownloadCancelledError(Exception):
+    """Raised when a download is stopped by STOP_DOWNLOADS."""
+
+
+def fetch_to_partial(
+    session, url, partial_path, validators, conditional=False, expected_sha256=None
+):
+    """
+    Streams the URL into partial_path using the requests session. If
+    partial_path already holds the start of the file, only the remaining bytes
+    are requested using an HTTP Range request.
+
+    validators holds the ETag and Last-Modified of the remote file, and is
+    updated in place when the response arrives. If conditional is set, the
+    request only returns a body if the remote file has changed since, and
+    False is returned if it has not. Otherwise, they make sure that a resumed
+    download continues the same version of the file.
+
+    If expected_sha256 is given, the checksum of the file is computed while it
+    is written. On a mismatch the partial file is removed and
+    ChecksumMismatchError is raised.
+
+    If STOP_DOWNLOADS is set, DownloadCancelledError is raised after writing
+    the current chunk, and the partial file is kept.
+    """
+    while True:
+        if STOP_DOWNLOADS.is_set():
+            raise DownloadCancelledError("Downloads were stopped")
+        existing = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        headers = {}
+        if conditional:
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                headers["If-Modified-Since"] = validators["last_modified"]
+        elif existing:
+            headers["Range"] = f"bytes={existing}-"
+            # Weak ETags can not be used for range requests
+            etag = validators.get("etag", "")
+            if_range = etag if not etag.startswith("W/") else ""
+            if_range = if_range or validators.get("last_modified")
+            if if_range:
+                headers["If-Range"] = if_range
+        with session.get(
+            url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT
+        ) as response:
+            if conditional and response.status_code == 304:
+                return False
+            content_range = response.headers.get("Content-Range", "")
+            if existing and (
+                response.status_code == 416
+                or (
+                    response.status_code == 206
+                    and not content_range.startswith(f"bytes {existing}-")
+                )
+            ):
+                # The partial file does not match the remote file. Start over
+                # with a new request once this response is closed.
+                os.remove(partial_path)
+                validators.clear()
+                continue
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+            if response.status_code == 200 or not validators:
+                validators.clear()
+                validators.update(get_validators(response))
+
+            # 206 Partial Content continues the file, while 200 means that the
+            # server ignored the Range header and sends the whole file.
+            offset = existing if response.status_code == 206 else 0
+            sha256 = hashlib.sha256()
+            if offset and expected_sha256:
+                # Include the bytes from previous attempts in the checksum
+                with open(partial_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        sha256.update(chunk)
+            # The size of the partial file is where an interrupted download
+            # resumes, also after the process is killed. It is therefore only
+            # extended by received bytes, and never preallocated.
+            with open(partial_path, "ab" if offset else "wb") as f:
+                # Read the raw stream in chunks of up to DOWNLOAD_CHUNK_SIZE,
+                # and compute the checksum on the bytes in flight rather than
+                # reading the file again later. read1() returns the bytes that
+                # have arrived instead of waiting for a full chunk, which read()
+                # discards if the connection breaks, so that an interrupted
+                # download keeps everything received. urllib3 1.x only has
+                # read(). Note that urllib3 implements readinto() as read()
+                # followed by a copy, so reading into a reused buffer would not
+                # save allocations.
+                response.raw.decode_content = True
+                read = getattr(response.raw, "read1", response.raw.read)
+                try:
+                    while chunk := read(DOWNLOAD_CHUNK_SIZE):
+                        if expected_sha256:
+                            sha256.update(chunk)
+                        f.write(chunk)
+                        if STOP_DOWNLOADS.is_set():
+                            raise DownloadCancelledError("Downloads were stopped")
+                except ProtocolError as e:
+                    # Raised as ChunkedEncodingError by requests' iter_content
+                    raise requests.exceptions.ChunkedEncodingError(e) from e
+                except ReadTimeoutError as e:
+                    raise requests.exceptions.ConnectionError(e) from e
+                except SSLError as e:
+                    raise requests.exceptions.SSLError(e) from e
+                except DecodeError as e:
+                    raise requests.exceptions.ContentDecodingError(e) from e
+                f.flush()
+                # The packages are not read again by this script, so ask the
+                # kernel to drop them from the page cache. This is best effort:
+                # the file is not synced, and Linux only drops pages that have
+                # already been written back, typically the start of a large
+                # package, and keeps the dirty ones.
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        break
+
+    if expected_sha256 and sha256.hexdigest() != expected_sha256.lower():
+        os.remove(partial_path)
+        validators.clear()
+        raise ChecksumMismatchError(
+            f"sha256 {sha256.hexdigest()} does not match {expected_sha256} from the lockfile"
+        )
+    return True
 
 
-def download_package(url, base_output_dir, force_download=False):
+def get_url_cache_path(lockfile_path):
     """
-    Downloads a single package URL into the appropriate platform subdirectory
-    within the base_output_dir.
+    Returns the path of the URL cache for the current lockfile contents, or
+    None if the lockfile cannot be read. Since the path depends on a hash of
+    the contents, any change to the lockfile invalidates the cache.
     """
-    output_path = ""  # Initialize for cleanup logic
     try:
-        parsed_url = urllib.parse.urlparse(url)
-        filename = os.path.basename(parsed_url.path)
-        if not filename:
-            print(
-                f"Error: Could not determine filename from URL: {url}. Skipping.",
-                file=sys.stderr,
-            )
-            return False
-
-        # Extract platform subdir from URL (e.g., linux-64, noarch)
-        # Path components: e.g. /conda-forge/linux-64/package-name.conda
-        path_components = [comp for comp in parsed_url.path.split("/") if comp]
-        if (
-            len(path_components) < 2
-        ):  # Needs at least channel/subdir/filename or subdir/filename
-            print(
-                f"Error: Could not determine platform subdirectory from URL path: {parsed_url.path}. Skipping {filename}.",
-                file=sys.stderr,
-            )
-            return False
+        with open(lockfile_path, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None  # Reported by load_lockfile
+    return os.path.join(CACHE_DIR, f"packages-{digest}.json")
 
-        # The subdir is typically the second to last component in the path
-        # e.g. ['conda-forge', 'linux-64', 'some-package.conda'] -> 'linux-64'
-        # e.g. ['my-channel', 'noarch', 'other-package.conda'] -> 'noarch'
-        platform_subdir_name = path_components[-2]
 
-        # Create platform-specific directory
-        platform_output_dir = os.path.join(base_output_dir, platform_subdir_name)
-        if not os.path.exists(platform_output_dir):
-            try:
-                os.makedirs(platform_output_dir, exist_ok=True)
-                print(f"Created platform directory: '{platform_output_dir}'")
-            except OSError as e:
-                print(
-                    f"Error: Could not create platform directory '{platform_output_dir}': {e}",
-                    file=sys.stderr,
-                )
-                return False
+def get_validators_cache_path(output_dir):
+    """
+    Returns the path of the file recording the ETag and Last-Modified of the
+    packages downloaded into output_dir.
+    """
+    digest = hashlib.blake2b(
+        os.path.abspath(output_dir).encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return os.path.join(CACHE_DIR, f"validators-{digest}.json")
 
-        output_path = os.path.join(platform_output_dir, filename)
 
-        if not force_download and os.path.exists(output_path):
-            print(
-                f"Skipping '{filename}': File already exists in '{platform_output_dir}'."
+def read_cache_file(cache_path):
+    """Reads a JSON cache file, or returns None if it is missing or unreadable."""
+    try:
+        with open(cache_path, "rb") as f:
+            contents = f.read()
+        return orjson.loads(contents) if orjson is not None else json.loads(contents)
+    except (OSError, ValueError):  # orjson.JSONDecodeError is a ValueError
+        return None
+
+
+def write_cache_file(cache_path, data):
+    """Atomically writes data to a JSON cache file."""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    if orjson is not None:
+        contents = orjson.dumps(data)
+    else:
+        contents = json.dumps(data).encode("utf-8")
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not write cache file '{cache_path}': {e}")
+
+
+def load_cached_urls(cache_path):
+    """
+    Loads the cached list of (url, sha256) pairs, or returns None if there is
+    none.
+    """
+    urls = read_cache_file(cache_path)
+    if not isinstance(urls, list) or not all(
+        isinstance(pair, list)
+        and len(pair) == 2
+        and isinstance(pair[0], str)
+        and isinstance(pair[1], (str, type(None)))
+        for pair in urls
+    ):
+        return None
+    return [tuple(pair) for pair in urls]
+
+
+def parse_package_urls(conda_urls):
+    """
+    Splits the (url, sha256) pairs into (platform_subdir_name, filename, url,
+    sha256) tuples, such that download workers do not need to parse them. URLs
+    without a platform subdirectory and filename are reported and left out.
+    """
+    packages = []
+    for url, sha256 in conda_urls:
+        match = PACKAGE_URL_PATTERN.match(url)
+        if match is None:
+            logger.error(
+                f"Could not determine platform subdirectory and filename from URL: {url}. Skipping."
             )
-            return True  # Considered a success as the file is present
+            continue
+        # The subdir is the second to last component in the path, e.g.
+        # .../conda-forge/linux-64/some-package.conda -> 'linux-64'
+        packages.append((match.group(1), match.group(2), url, sha256))
+    return packages
+
 
-        print(f"Downloading '{filename}' to '{platform_output_dir}' from '{url}'...")
-        response = requests.get(url, stream=True, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+def deduplicate_packages(packages):
+    """
+    Keeps a single URL for packages with the same platform subdirectory and
+    filename, which different channels may provide. These would be written to
+    the same path in the output directory, so only one of them is downloaded.
+    Returns the remaining packages and the number of duplicates left out.
+    """
+    unique = {}
+    for package in sorted(packages, key=lambda package: package[2]):
+        platform_subdir_name, filename, url, sha256 = package
+        kept = unique.setdefault((platform_subdir_name, filename), package)
+        if sha256 and kept[3] and sha256.lower() != kept[3].lower():
+            logger.warning(
+                f"'{url}' and '{kept[2]}' have different sha256 checksums "
+                f"in the lockfile. Only '{kept[2]}' is downloaded."
+            )
+    return list(unique.values()), len(packages) - len(unique)
+
+
+def create_platform_dirs(base_output_dir, packages):
+    """
+    Creates the platform subdirectories needed by the packages, and returns
+    the names of the files that already exist in them, keyed on platform. A
+    single directory scan per platform replaces a file check per package.
+    """
+    platforms = {package[0] for package in packages}
+    # One scan of the base directory tells which platform directories exist
+    with os.scandir(base_output_dir) as entries:
+        existing_dirs = {entry.name for entry in entries if entry.is_dir()}
+
+    present = {}
+    for platform_subdir_name in sorted(platforms):
+        platform_output_dir = os.path.join(base_output_dir, platform_subdir_name)
+        if platform_subdir_name in existing_dirs:
+            with os.scandir(platform_output_dir) as entries:
+                present[platform_subdir_name] = {
+                    entry.name for entry in entries if entry.is_file()
+                }
+            continue
+        try:
+            # The base directory is created by main(), so no parents are needed
+            os.mkdir(platform_output_dir)
+            logger.info(f"Created platform directory: '{platform_output_dir}'")
+        except OSError as e:
+            logger.error(
+                f"Could not create platform directory '{platform_output_dir}': {e}"
+            )
+            sys.exit(1)
+        present[platform_subdir_name] = set()
+    return present
+
+
+def download_one(
+    session,
+    url,
+    output_path,
+    expected_sha256=None,
+    validators=None,
+    restart=False,
+    host_semaphore=None,
+):
+    """
+    Downloads a single package URL to output_path, whose directory must exist.
 
-        with open(output_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
-                f.write(chunk)
+    If validators holds the ETag and Last-Modified of an existing output_path,
+    the file is only downloaded again if it has changed on the server. If
+    restart is set, an incomplete download from an earlier run is discarded
+    instead of resumed. If expected_sha256 is given, the download is verified
+    against it. If host_semaphore is given, it is held while downloading.
 
-        print(f"Successfully downloaded '{filename}' to '{platform_output_dir}'.")
-        return True
+    Returns the ETag and Last-Modified of the downloaded file (or the given
+    validators if the file is unchanged), or None if the download failed.
+    """
+    platform_output_dir, filename = os.path.split(output_path)
+    partial_path = output_path + PARTIAL_SUFFIX
+    try:
+        # A conditional request only sends the file if it has changed
+        remote = dict(validators or {})
+        conditional = bool(remote)
+        if (restart or conditional) and os.path.exists(partial_path):
+            os.remove(partial_path)
+
+        logger.debug(
+            f"Downloading '{filename}' to '{platform_output_dir}' from '{url}'..."
+        )
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                # The semaphore is released while waiting to retry
+                with host_semaphore or contextlib.nullcontext():
+                    modified = fetch_to_partial(
+                        session,
+                        url,
+                        partial_path,
+                        remote,
+                        conditional,
+                        expected_sha256,
+                    )
+                break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                ChecksumMismatchError,
+            ) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                delay = DOWNLOAD_RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(
+                    f"Download of '{filename}' failed ({e}). "
+                    f"Retrying in {delay:.0f}s (attempt {attempt + 1}/{DOWNLOAD_ATTEMPTS})..."
+                )
+                STOP_DOWNLOADS.wait(delay)
+                # Resume whatever was received, instead of asking again
+                conditional = False
+        if not modified:
+            logger.debug(f"Skipping '{filename}': File is unchanged on the server.")
+            return validators
+        os.replace(partial_path, output_path)
+
+        logger.debug(
+            f"Successfully downloaded '{filename}' to '{platform_output_dir}'."
+        )
+        return remote
 
+    except DownloadCancelledError:
+        logger.debug(f"Stopped downloading '{filename}'.")
+    except ChecksumMismatchError as e:
+        logger.error(f"Checksum Error downloading '{filename}': {e}")
     except requests.exceptions.HTTPError as e:
-        print(
-            f"HTTP Error downloading '{filename}': {e.response.status_code} {e.response.reason}",
-            file=sys.stderr,
+        logger.error(
+            f"HTTP Error downloading '{filename}': {e.response.status_code} {e.response.reason}"
         )
     except requests.exceptions.ConnectionError as e:
-        print(f"Connection Error downloading '{filename}': {e}", file=sys.stderr)
+        logger.error(f"Connection Error downloading '{filename}': {e}")
     except requests.exceptions.Timeout as e:
-        print(f"Timeout during download of '{filename}': {e}", file=sys.stderr)
+        logger.error(f"Timeout during download of '{filename}': {e}")
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading '{filename}': {e}", file=sys.stderr)
+        logger.error(f"Error downloading '{filename}': {e}")
     except Exception as e:
-        print(
-            f"An unexpected error occurred while processing '{url}': {e}",
-            file=sys.stderr,
-        )
+        logger.error(f"An unexpected error occurred while processing '{url}': {e}")
 
-    # Cleanup partially downloaded file if an error occurred
-    if output_path and os.path.exists(output_path) and os.path.isfile(output_path):
-        try:
-            # Check if file size is 0, often indicative of an interrupted download start
-            if os.path.getsize(output_path) == 0:
-                print(
-                    f"Note: '{filename}' was 0 bytes and might be a partial download due to error.",
-                    file=sys.stderr,
-                )
-            os.remove(output_path)
-            print(
-                f"Cleaned up potentially incomplete file: {output_path}",
-                file=sys.stderr,
-            )
-        except OSError as oe:
-            print(f"Error cleaning up file {output_path}: {oe}", file=sys.stderr)
-    return False
+    # Keep the partially downloaded file, such that the next run can resume it
+    if os.path.isfile(partial_path):
+        logger.info(
+            f"Keeping incomplete download '{partial_path}' to resume on the next run."
+        )
+    return None
 
 
 def main():
     """Main function to orchestrate the download process."""
     args = parse_arguments()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    # Only log debug messages from this script, not from requests and urllib3
+    logging.getLogger("urllib3").setLevel(logging.INFO)
 
     # Create base output directory if it doesn't exist
     if not os.path.exists(args.output_dir):
         try:
             os.makedirs(args.output_dir, exist_ok=True)  # exist_ok=True is fine here
-            print(f"Created base output directory: '{args.output_dir}'")
+            logger.info(f"Created base output directory: '{args.output_dir}'")
         except OSError as e:
-            print(
-                f"Error: Could not create base output directory '{args.output_dir}': {e}",
-                file=sys.stderr,
+            logger.error(
+                f"Could not create base output directory '{args.output_dir}': {e}"
             )
             sys.exit(1)
     elif not os.path.isdir(args.output_dir):
-        print(
-            f"Error: Output path '{args.output_dir}' exists but is not a directory.",
-            file=sys.stderr,
-        )
+        logger.error(f"Output path '{args.output_dir}' exists but is not a directory.")
         sys.exit(1)
 
     if not os.access(args.output_dir, os.W_OK):
-        print(
-            f"Error: Output directory '{args.output_dir}' is not writable.",
-            file=sys.stderr,
-        )
+        logger.error(f"Output directory '{args.output_dir}' is not writable.")
         sys.exit(1)
 
-    print(f"Loading lockfile: '{args.lockfile}'")
-    lockfile_data = load_lockfile(args.lockfile)
+    cache_path = get_url_cache_path(args.lockfile)
+    conda_urls = load_cached_urls(cache_path) if cache_path else None
+    if conda_urls is not None:
+        logger.info(
+            f"Using cached package URLs for '{args.lockfile}' from '{cache_path}'"
+        )
+    else:
+        logger.info(f"Loading lockfile: '{args.lockfile}'")
+        lockfile_data = load_lockfile(args.lockfile)
 
-    print("Extracting Conda package URLs...")
-    conda_urls = extract_conda_package_urls(lockfile_data)
+        logger.info("Extracting Conda package URLs...")
+        conda_urls = extract_conda_package_urls(lockfile_data)
+        if cache_path and conda_urls:
+            write_cache_file(cache_path, conda_urls)
 
     if not conda_urls:
-        print("No packages to download. Exiting.")
+        logger.info("No packages to download. Exiting.")
         sys.exit(0)
 
-    print(f"\nFound {len(conda_urls)} unique Conda package URLs to process.")
+    logger.info(f"Found {len(conda_urls)} unique Conda package URLs to process.")
+
+    packages = parse_package_urls(conda_urls)
+    invalid_count = len(conda_urls) - len(packages)
+    packages, duplicate_count = deduplicate_packages(packages)
+    if duplicate_count:
+        logger.info(
+            f"{duplicate_count} URLs provide the same file as another URL "
+            "and are only downloaded once."
+        )
+    present = create_platform_dirs(args.output_dir, packages)
+    validators_path = get_validators_cache_path(args.output_dir)
+    validators = read_cache_file(validators_path)
+    if not isinstance(validators, dict):
+        validators = {}
 
     success_count = 0
-    failure_count = 0
-    skipped_count = 0
-
-    for i, url in enumerate(conda_urls, 1):
-        print(f"\n--- Processing package {i}/{len(conda_urls)} ---")
-
-        # Determine potential filename and subdir for pre-check if not forcing
-        # This is a bit more complex due to subdir logic being inside download_package
-        # For a simple skipped count, we can rely on download_package's return or its print.
-        # Let's refine the skipped logic slightly.
-
-        # The `download_package` function now handles the "already exists" check and prints it.
-        # We just need to interpret its return value.
-
-        is_successful_or_skipped = download_package(url, args.output_dir, args.force)
-
-        if is_successful_or_skipped:
-            success_count += 1
-            # To accurately count skips, we need more info from download_package or check here.
-            # For simplicity, if not forcing and file exists, download_package returns True.
-            # We can refine this if a distinct "skipped" vs "newly_downloaded" count is critical.
-            # The current print from download_package already says "Skipping..."
-        else:
-            failure_count += 1
-        # print("-" * 30) # Separator is now within the loop start
-
-    print("\n--- Download Summary ---")
-    print(f"  Total URLs found: {len(conda_urls)}")
+    failure_count = invalid_count
+
+    # Decide up front which packages to download, such that the download
+    # workers only need to fetch and write files.
+    downloads = []
+    for platform_subdir_name, filename, url, sha256 in packages:
+        output_path = os.path.join(args.output_dir, platform_subdir_name, filename)
+        known_validators = None
+        if not args.force and filename in present[platform_subdir_name]:
+            if args.revalidate:
+                known_validators = validators.get(url)
+            if not known_validators:
+                logger.debug(
+                    f"Skipping '{filename}': File already exists in '{os.path.dirname(output_path)}'."
+                )
+                success_count += 1  # Considered a success as the file is present
+                continue
+        downloads.append((url, output_path, sha256, known_validators))
+
+    # Limit the number of concurrent downloads from each host
+    host_semaphores = collections.defaultdict(
+        lambda: threading.BoundedSemaphore(args.max_per_host)
+    )
+    if args.jobs > POOL_MAXSIZE:
+        # Every worker needs its own connection to avoid discarding connections
+        mount_adapter(SESSION, args.jobs)
+    progress = (
+        tqdm(
+            total=len(packages),
+            initial=len(packages) - len(downloads),
+            unit="pkg",
+            desc="Downloading",
+        )
+        if tqdm is not None
+        else contextlib.nullcontext()
+    )
+    # Keep log messages from breaking up the progress bar
+    redirect = logging_redirect_tqdm() if tqdm is not None else contextlib.nullcontext()
+    # Downloads are I/O bound and independent of each other, so run them in a
+    # thread pool. Output from concurrent downloads may interleave.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    with progress, redirect:
+        futures = {
+            executor.submit(
+                download_one,
+                SESSION,
+                url,
+                output_path,
+                sha256,
+                known_validators,
+                args.force,
+                # The host of a parsed package URL, i.e. scheme://host/path
+                host_semaphores[url.split("/", 3)[2]],
+            ): url
+            for url, output_path, sha256, known_validators in downloads
+        }
+        try:
+            for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                # download_one returns the validators of the file on success,
+                # both for new downloads and for files that are unchanged on
+                # the server.
+                result = future.result()
+                if result is None:
+                    failure_count += 1
+                else:
+                    success_count += 1
+                    if result:
+                        validators[futures[future]] = result
+                if tqdm is not None:
+                    progress.update(1)
+                else:
+                    logger.debug(f"Processed {i}/{len(downloads)} downloads")
+        except KeyboardInterrupt:
+            # Cancel the queued downloads, and stop the running ones after
+            # their current chunk rather than waiting for all of them. Their
+            # partial files are resumed on the next run.
+            logger.error("Interrupted, cancelling the remaining downloads")
+            STOP_DOWNLOADS.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            write_cache_file(validators_path, validators)
+            sys.exit(130)
+    executor.shutdown()
+    write_cache_file(validators_path, validators)
+
+    logger.info("--- Download Summary ---")
+    logger.info(f"  Total URLs found: {len(conda_urls)}")
     # success_count includes files that were successfully downloaded + files that were skipped (already existed)
-    print(f"  Successfully processed (downloaded or already existed): {success_count}")
-    print(f"  Failed downloads: {failure_count}")
-    print("------------------------")
+    logger.info(
+        f"  Successfully processed (downloaded or already existed): {success_count}"
+    )
+    logger.info(f"  Duplicates of other URLs (downloaded once): {duplicate_count}")
+    logger.info(f"  Failed downloads: {failure_count}")
+    logger.info("------------------------")
 
     if failure_count > 0:
-        print(
-            "\nSome packages failed to download. Please check the errors above.",
-            file=sys.stderr,
-        )
+        logger.error("Some packages failed to download. Please check the errors above.")
         sys.exit(1)
     else:
-        print("\nAll specified packages processed successfully.")
+        logger.info("All specified packages processed successfully.")
 
 
 if __name__ == "__main__":